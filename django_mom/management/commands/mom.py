@@ -2,25 +2,43 @@ import enum
 import logging
 import os
 import re
-from os import listdir
-from os.path import getsize, getmtime, isdir, isfile, join
+from collections import deque
+from os.path import join
 from pathlib import Path
 from typing import BinaryIO
 
 import yaml
-from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import QuerySet, Model, ForeignKey, OneToOneField, ManyToManyField
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import QuerySet, Model, ForeignKey, OneToOneField, ManyToManyField, signals
 from django.utils.module_loading import import_string
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 from ...settings import MOM_FOLDER, MOM_FILE
 
 KEY_PATTERN = "([a-zA-Z0-9-_]+)"
-FILE_PATTERN_FULL = f"^{KEY_PATTERN}.{KEY_PATTERN}.{MOM_FILE}$"
-FILE_PATTERN_FOLDER = f"^{KEY_PATTERN}.{MOM_FILE}$"
-FILE_PATTERN_PRIVATE = f"^{KEY_PATTERN}$"
+FILE_PATTERN_FULL = re.compile(f"{KEY_PATTERN}\\.{KEY_PATTERN}\\.{re.escape(MOM_FILE)}")
+FILE_PATTERN_FOLDER = re.compile(f"{KEY_PATTERN}\\.{re.escape(MOM_FILE)}")
+FILE_PATTERN_PRIVATE = re.compile(KEY_PATTERN)
+
+VERBOSITY_LOG_LEVELS = {
+    0: logging.WARNING,
+    1: logging.INFO,
+}
 
-logging.basicConfig(level=logging.NOTSET)
+_IMPORT_CACHE = {}
+_FIELD_CACHE = {}
+_AUTO_NOW_CACHE = {}
+_FIELD_KEY_CACHE = {}
+_LOGGER_CACHE = {}
+
+logger = logging.getLogger(__name__)
+_CLASS_NAME_CACHE = {}
 
 
 class MOMException(Exception):
@@ -43,19 +61,44 @@ class UnsupportedValueException(MOMException):
     pass
 
 
+class FileLoadException(MOMException):
+    pass
+
+
+class ModelImportException(MOMException):
+    pass
+
+
+class ImplicitLookupException(MOMException):
+    pass
+
+
+class IncompleteMappingException(MOMException):
+    pass
+
+
 class DjangoFile:
+    __slots__ = ('file_name', 'file_size', 'file_path', 'date_modified')
+
     file_name: str
     file_size: int
-    file: BinaryIO
+    file_path: str
     date_modified: float
 
-    def __init__(self, file_name: str, file_size: int, file: BinaryIO, date_modified: float) -> None:
+    def __init__(self, file_name: str, file_size: int, file_path: str, date_modified: float) -> None:
         super().__init__()
         self.file_name = file_name
         self.file_size = file_size
-        self.file = file
+        self.file_path = file_path
         self.date_modified = date_modified
 
+    def open(self) -> BinaryIO:
+        return open(self.file_path, 'rb')
+
+
+# Values that can only be assigned once the object exists in the database.
+SECONDARY_FIELD_TYPES = {list, DjangoFile}
+
 
 class Ownership(enum.Enum):
     NONE = 'none'
@@ -64,10 +107,17 @@ class Ownership(enum.Enum):
 
 
 class MOM:
+    __slots__ = ('mapping', 'remapping', 'django_models', 'implicit_lookup_fields', 'remappers', 'prefetched_objects',
+                 'prefetched_references', 'changed_objects')
+
     mapping: dict
     remapping: dict
     django_models: dict
     implicit_lookup_fields: dict
+    remappers: dict
+    prefetched_objects: dict
+    prefetched_references: dict
+    changed_objects: set
 
     def __init__(self, mapping: dict, remapping: dict, django_models: dict, implicit_lookup_fields: dict) -> None:
         super().__init__()
@@ -75,12 +125,16 @@ class MOM:
         self.remapping = remapping if remapping is not None else {}
         self.django_models = django_models
         self.implicit_lookup_fields = implicit_lookup_fields
+        self.remappers = {}
+        self.prefetched_objects = {}
+        self.prefetched_references = {}
+        self.changed_objects = set()
 
     @staticmethod
     def load_from(mom_file: str):
         try:
-            with open(mom_file, 'r') as stream:
-                yaml_index = yaml.safe_load(stream)
+            with open(mom_file, 'rb') as stream:
+                yaml_index = yaml.load(stream, Loader=SafeLoader)
                 mom_index = yaml_index['mom']
                 mapping = mom_index['map']
                 remapping = None if "remap" not in mom_index else mom_index['remap']
@@ -111,32 +165,42 @@ class MOM:
                         django_models[model_import_name] = MOM._map_django_models(model_import_name, "_REMAP")
 
                 return MOM(mapping, remapping, django_models, implicit_lookup_fields)
-        except IOError:
-            logging.error(f"Couldn't open '{mom_file}' file.")
-            exit(1)
-        except Exception as exc:
-            raise exc
+        except (IOError, yaml.YAMLError, KeyError, TypeError) as exc:
+            logger.error(f"Couldn't load '{mom_file}' file.")
+            logger.exception(exc)
+            raise FileLoadException([mom_file]) from exc
 
     @staticmethod
     def _map_django_models(model_import_name: str, map_name: str):
+        model_class = _IMPORT_CACHE.get(model_import_name)
+        if model_class is not None:
+            return model_class
+
         try:
-            logging.info(f"Locating Django model: {model_import_name}")
-            return import_string(model_import_name)
-        except ImportError:
-            logging.error(f"Could not import `{model_import_name} for `{map_name}` defined in {MOM_FILE}")
-            exit(1)
+            logger.info("Locating Django model: %s", model_import_name)
+            model_class = import_string(model_import_name)
+            _IMPORT_CACHE[model_import_name] = model_class
+            return model_class
+        except ImportError as exc:
+            logger.error(f"Could not import `{model_import_name} for `{map_name}` defined in {MOM_FILE}")
+            raise ModelImportException(model_import_name) from exc
 
 
 class Mapper:
+    __slots__ = ('mom', 'map_name', 'fields', 'pwd', 'file', 'lookup_field_value', 'loaded', 'logger', 'file_contents',
+                 'lookup_field_name', 'model_class')
+
     mom: MOM
     map_name: str
     fields: dict
-    mapping: dict
     pwd: str
     file: str
     lookup_field_value: str
-    loaded = False
+    loaded: bool
     logger: logging
+    file_contents: dict
+    lookup_field_name: str
+    model_class: type
 
     def __init__(self, mom: MOM, map_name: str, pwd: str, file: str, fields: dict, lookup_field_value: str) -> None:
         super().__init__()
@@ -146,102 +210,268 @@ class Mapper:
         self.pwd = pwd
         self.file = file
         self.lookup_field_value = lookup_field_value
-        self.logger = logging.getLogger("mapper:%s:%s" % (map_name, lookup_field_value))
+        self.loaded = False
+        self.lookup_field_name = mom.mapping[map_name]['lookupField']
+        self.model_class = mom.django_models[map_name]
+        self.logger = Mapper.get_logger(map_name)
+        self.file_contents = {}
 
         if self.lookup_field_name not in self.fields:
             self.fields[self.lookup_field_name] = self.lookup_field_value
 
     @staticmethod
-    def flatten_lookup_fields(lookup_fields: dict, parent_key: str = None, flattened_fields=None) -> dict:
-        if flattened_fields is None:
-            flattened_fields = {}
-        for key, value in lookup_fields.items():
-            qual_key = key if parent_key is None else f"{parent_key}__{key}"
-            if isinstance(value, dict):
-                Mapper.flatten_lookup_fields(value, qual_key, flattened_fields)
-            elif isinstance(value, list):
-                logging.error("A list value cannot be flattened")
-                raise UnsupportedValueException
-            else:
-                flattened_fields[qual_key] = value
+    def get_logger(map_name: str) -> logging.Logger:
+        if map_name not in _LOGGER_CACHE:
+            _LOGGER_CACHE[map_name] = logging.getLogger(f"{__name__}.{map_name}")
+        return _LOGGER_CACHE[map_name]
+
+    @staticmethod
+    def flatten_lookup_fields(lookup_fields: dict, parent_key: str = None) -> dict:
+        flattened_fields = {}
+        pending = [(parent_key, lookup_fields)]
+
+        while pending:
+            parent_key, lookup_fields = pending.pop()
+            for key, value in lookup_fields.items():
+                qual_key = key if parent_key is None else f"{parent_key}__{key}"
+                value_type = type(value)
+                if value_type is dict:
+                    pending.append((qual_key, value))
+                elif value_type is list:
+                    logger.error("A list value cannot be flattened")
+                    raise UnsupportedValueException
+                else:
+                    flattened_fields[qual_key] = value
 
         return flattened_fields
 
     @staticmethod
     def load_from(mom: MOM, map_name: str, lookup_field_value: str, pwd, file):
-        logger = logging.getLogger(map_name)
+        logger = Mapper.get_logger(map_name)
         mom_file = join(pwd, file)
         fields = None
 
         try:
-            with open(mom_file, 'r') as stream:
-                fields = yaml.safe_load(stream)['field']
+            with open(mom_file, 'rb') as stream:
+                fields = yaml.load(stream, Loader=SafeLoader)['field']
         except Exception as exc:
             logger.exception(exc)
-            exit(1)
+            raise FileLoadException([mom_file]) from exc
 
         mapper = Mapper(mom, map_name, pwd, file, fields, lookup_field_value)
 
-        logger.info(f"""Loaded object: `{mapper.lookup_field_value}:{mapper.lookup_field_name}` of `{map_name}` """
-                    f"""from {join(pwd, file)}""")
+        logger.info("Loaded object: `%s:%s` of `%s` from %s", mapper.lookup_field_value, mapper.lookup_field_name,
+                    map_name, mom_file)
 
         return mapper
 
     @staticmethod
-    def load_mappers_from(mom: MOM, mom_folder: str, mom_file: str) -> list:
+    def find_mapping_files(mom: MOM, mom_folder: str, mom_file: str) -> list:
         def warn_maybe_missing(missing_name: str, is_file: bool):
             if not missing_name.startswith("_"):
-                logging.warning(f"The {'file' if is_file else 'folder'} `{missing_name}` is not included in mapping. "
-                                "If this is not a mapping file, prepend it with an underscore (_).")
+                logger.warning("The %s `%s` is not included in mapping. If this is not a mapping file, prepend it "
+                                "with an underscore (_).", 'file' if is_file else 'folder', missing_name)
 
-        mappers = []
+        mapping_files = []
 
-        for main_file in listdir(mom_folder):
-            main_full_path = join(mom_folder, main_file)
+        with os.scandir(mom_folder) as main_entries:
+            for main_entry in main_entries:
+                main_file = main_entry.name
 
-            if isfile(main_full_path):
-                matches = re.findall(FILE_PATTERN_FULL, main_file)
-                if len(matches) < 1:
-                    continue
+                if main_entry.is_file():
+                    match = FILE_PATTERN_FULL.fullmatch(main_file)
+                    if match is None:
+                        continue
 
-                (model_name, map_name) = matches[0]
+                    (model_name, map_name) = match.groups()
 
-                if model_name in mom.mapping:
-                    mappers.append(Mapper.load_from(mom, model_name, map_name, mom_folder, main_file))
-                else:
-                    warn_maybe_missing(main_file, True)
-            elif isdir(main_full_path):
-                model_name = main_file
-                not_in_mapping = model_name not in mom.mapping
-                if len(re.findall(FILE_PATTERN_PRIVATE, main_file)) != 1 or not_in_mapping:
-                    if not_in_mapping:
+                    if model_name in mom.mapping:
+                        mapping_files.append((model_name, map_name, mom_folder, main_file))
+                    else:
+                        warn_maybe_missing(main_file, True)
+                elif main_entry.is_dir():
+                    model_name = main_file
+                    if model_name not in mom.mapping:
                         warn_maybe_missing(main_file, False)
-                    continue
+                        continue
+                    elif FILE_PATTERN_PRIVATE.fullmatch(main_file) is None:
+                        continue
 
-                for child_file in listdir(main_full_path):
-                    child_full_path = join(main_full_path, child_file)
+                    with os.scandir(main_entry.path) as child_entries:
+                        for child_entry in child_entries:
+                            child_file = child_entry.name
 
-                    if isdir(child_full_path):
-                        map_name = child_file
-                        if len(re.findall(FILE_PATTERN_PRIVATE, map_name)) == 1:
-                            mappers.append(Mapper.load_from(mom, model_name, map_name, child_full_path, mom_file))
-                    elif isfile(child_full_path):
-                        matches = re.findall(FILE_PATTERN_FOLDER, child_file)
-                        if len(matches) < 1:
-                            continue
+                            if child_entry.is_dir():
+                                map_name = child_file
+                                if FILE_PATTERN_PRIVATE.fullmatch(map_name) is not None:
+                                    mapping_files.append((model_name, map_name, child_entry.path, mom_file))
+                            elif child_entry.is_file():
+                                match = FILE_PATTERN_FOLDER.fullmatch(child_file)
+                                if match is None:
+                                    continue
+
+                                (map_name,) = match.groups()
+                                mapping_files.append((model_name, map_name, main_entry.path, child_file))
+
+        return mapping_files
+
+    @staticmethod
+    def load_mappers_from(mom: MOM, mom_folder: str, mom_file: str) -> list:
+        mappers = []
+        failed_files = []
 
-                        (map_name) = matches[0]
-                        mappers.append(Mapper.load_from(mom, model_name, map_name, main_full_path, child_file))
+        for model_name, map_name, pwd, file in Mapper.find_mapping_files(mom, mom_folder, mom_file):
+            try:
+                mappers.append(Mapper.load_from(mom, model_name, map_name, pwd, file))
+            except FileLoadException:
+                # Already logged, keep going so every broken file is reported in one run.
+                failed_files.append(join(pwd, file))
+
+        if len(failed_files) > 0:
+            raise FileLoadException(failed_files)
 
         return mappers
 
-    @property
-    def lookup_field_name(self):
-        return self.mom.mapping[self.map_name]['lookupField']
+    @staticmethod
+    def get_django_field(model_class, field_name: str):
+        key = (model_class, field_name)
+        if key not in _FIELD_CACHE:
+            _FIELD_CACHE[key] = model_class._meta.get_field(field_name)
+        return _FIELD_CACHE[key]
+
+    @staticmethod
+    def get_auto_now_fields(model_class) -> list:
+        if model_class not in _AUTO_NOW_CACHE:
+            _AUTO_NOW_CACHE[model_class] = [
+                field.name for field in model_class._meta.concrete_fields if getattr(field, 'auto_now', False)
+            ]
+        return _AUTO_NOW_CACHE[model_class]
+
+    @staticmethod
+    def can_bulk_create(model_class) -> bool:
+        # `bulk_create` skips `save()` and its signals, and only some databases return the generated keys.
+        connection = connections[router.db_for_write(model_class)]
+        return (
+            connection.features.can_return_rows_from_bulk_insert
+            and len(model_class._meta.parents) == 0
+            and model_class.save is Model.save
+            and not signals.pre_save.has_listeners(model_class)
+            and not signals.post_save.has_listeners(model_class)
+        )
+
+    @staticmethod
+    def can_defer_children(model_class, children: list) -> bool:
+        # Children can only be inserted together if none of them would find another one by its lookup, or refer to one
+        # that isn't inserted yet. That is only certain when they are all looked up the same way, by the same plain
+        # fields, with values that differ even under a case-insensitive or space-padding collation, and none of them
+        # mentions the lookup values of another.
+        if any(field.is_relation and field.related_model is model_class for field in model_class._meta.get_fields()):
+            return False
+
+        if len({remapper for remapper, _, _ in children}) != 1:
+            return False
+
+        lookup_names = {tuple(child_lookup_fields.keys()) for _, child_lookup_fields, _ in children}
+        if len(lookup_names) != 1:
+            return False
+
+        (lookup_names,) = lookup_names
+        try:
+            django_fields = [Mapper.get_django_field(model_class, lookup_name) for lookup_name in lookup_names]
+            if any(django_field.is_relation for django_field in django_fields):
+                return False
+
+            values = {
+                tuple(Mapper.normalize_value(django_field.to_python(child_lookup_fields[lookup_name]))
+                      for lookup_name, django_field in zip(lookup_names, django_fields))
+                for _, child_lookup_fields, _ in children
+            }
+        except (FieldDoesNotExist, ValidationError):
+            return False
+
+        if len(values) != len(children):
+            return False
+
+        owners = {}
+        for index, (_, child_lookup_fields, _) in enumerate(children):
+            for value in child_lookup_fields.values():
+                owners.setdefault(Mapper.normalize_value(str(value)), set()).add(index)
+
+        for index, (_, _, child_field_values) in enumerate(children):
+            for value in Mapper.collect_values(child_field_values):
+                if len(owners.get(value, set()) - {index}) > 0:
+                    return False
 
-    @property
-    def model_class(self):
-        return self.mom.django_models[self.map_name]
+        return True
+
+    @staticmethod
+    def normalize_value(value):
+        return value.casefold().rstrip(' ') if type(value) is str else value
+
+    @staticmethod
+    def collect_values(fields) -> set:
+        values = set()
+        stack = [fields]
+        while stack:
+            value = stack.pop()
+            value_type = type(value)
+            if value_type is dict:
+                stack.extend(value.values())
+            elif value_type is list:
+                stack.extend(value)
+            elif value is not None:
+                values.add(Mapper.normalize_value(str(value)))
+        return values
+
+    @staticmethod
+    def prefetch_objects(
+            model_class,
+            lookup_fields_list: list,
+            reference_only: bool = False,
+            related_names: set = None,
+            prefetch_names: set = None,
+    ) -> list:
+        # Resolves lookups that share a single plain field with one `IN` query. Entries left as `None` are looked up
+        # separately by `_start_mapping`.
+        prefetched_objects = [None] * len(lookup_fields_list)
+        lookup_names = {tuple(lookup_fields.keys()) for lookup_fields in lookup_fields_list}
+
+        if len(lookup_fields_list) < 2 or len(lookup_names) != 1:
+            return prefetched_objects
+
+        (lookup_names,) = lookup_names
+        if len(lookup_names) != 1:
+            return prefetched_objects
+
+        (lookup_name,) = lookup_names
+        try:
+            django_field = Mapper.get_django_field(model_class, lookup_name)
+            if django_field.is_relation:
+                return prefetched_objects
+
+            values = [django_field.to_python(lookup_fields[lookup_name]) for lookup_fields in lookup_fields_list]
+        except (FieldDoesNotExist, ValidationError):
+            return prefetched_objects
+
+        query: QuerySet = model_class.objects.filter(**{f"{lookup_name}__in": set(values)})
+        if reference_only:
+            query = query.only(lookup_name)
+        if related_names:
+            query = query.select_related(*related_names)
+        if prefetch_names:
+            query = query.prefetch_related(*prefetch_names)
+
+        objects_by_value = {}
+        for db_object in query:
+            objects_by_value.setdefault(django_field.value_from_object(db_object), []).append(db_object)
+
+        for index, value in enumerate(values):
+            matches = objects_by_value.get(value)
+            # Missing or non-unique values go through the usual lookup, which also reports them.
+            if matches is not None and len(matches) == 1:
+                prefetched_objects[index] = matches[0]
+
+        return prefetched_objects
 
     def _start_mapping(
             self,
@@ -249,133 +479,186 @@ class Mapper:
             lookup_fields: dict,
             fields: dict,
             ownership: Ownership = Ownership.NONE,
-            db_object: Model = None
+            db_object: Model = None,
+            prefetched: bool = False,
+            defer_create: bool = False
     ) -> (bool, bool, object):
-        lookup_fields = Mapper.flatten_lookup_fields(lookup_fields)
         fields = self.streamline_fields(fields)
 
-        if db_object is None or ownership == Ownership.NONE:
+        if ownership == Ownership.NONE and not prefetched:
+            reference = self.mom.prefetched_references.get((model_class, tuple(lookup_fields.items())))
+            if reference is not None and (model_class, reference.pk) not in self.mom.changed_objects:
+                db_object = reference
+                prefetched = True
+
+        if db_object is None or (ownership == Ownership.NONE and not prefetched):
             query: QuerySet = model_class.objects.filter(**lookup_fields)
-            result_count = len(query.all())
+            if ownership == Ownership.NONE:
+                # Non-owned objects are only referenced, so their other columns are never read.
+                query = query.only('pk')
+            results = list(query[:2])
 
-            if result_count > 1:
-                self.logger.error(f"Not unique. There are more than one results for `{self.lookup_field_value}`")
+            if len(results) > 1:
+                self.logger.error(f"Not unique. There are more than one results for `{lookup_fields}`")
                 raise NonUniqueFieldException
 
-            db_object: Model = query.get() if result_count == 1 else None
+            db_object: Model = results[0] if len(results) == 1 else None
             updating = db_object is not None
         else:
             updating = True
 
         if ownership == Ownership.NONE:
             if updating:
-                self.logger.debug(f"Skip, non-updatable object `{lookup_fields}`")
+                self.logger.debug("Skip, non-updatable object `%s`", lookup_fields)
                 return True, False, db_object
             else:
-                self.logger.debug(f"Skip, non-creatable object `{lookup_fields}`")
+                self.logger.debug("Skip, non-creatable object `%s`", lookup_fields)
                 return False, False, None
 
         field_diff = {}
+        current_m2m_pks = {}
 
         if updating:
-            self.logger.debug(f"Object exists `{lookup_fields}`")
+            self.logger.debug("Object exists `%s`", lookup_fields)
         else:
-            self.logger.debug(f"Creation needed for object `{lookup_fields}`")
+            self.logger.debug("Creation needed for object `%s`", lookup_fields)
 
         for field_name, field_values in fields.items():
-            django_field = model_class._meta.get_field(field_name)
+            django_field = Mapper.get_django_field(model_class, field_name)
+            current_value = getattr(db_object, field_name) if updating else None
 
             if isinstance(django_field, ManyToManyField):
                 related_model_class = django_field.related_model
                 remapper = Remapper.create_from(self.mom, django_field.related_model)
                 list_of_fields = []
-                set_m2m = list(getattr(db_object, field_name).all()) if updating else None
-                even = updating and len(set_m2m) == len(field_values)
                 should_update = False
 
-                if field_values is None and (set_m2m is not None or not updating):
+                if field_values is None:
                     field_diff[field_name] = list_of_fields
                     continue
 
+                set_m2m = None
+                set_m2m_pks = None
+                if updating:
+                    if (remapper is not None and remapper.ownership == Ownership.SINGLE) or field_name in getattr(
+                            db_object, '_prefetched_objects_cache', ()):
+                        # Owned values may have to be deleted, and prefetched ones are already loaded.
+                        set_m2m = list(current_value.all())
+                        set_m2m_pks = {existing_value.pk for existing_value in set_m2m}
+                    else:
+                        set_m2m_pks = set(current_value.values_list('pk', flat=True))
+                    current_m2m_pks[field_name] = set_m2m_pks
+
+                even = updating and len(set_m2m_pks) == len(field_values)
+
+                children = []
+                implicit_remappers = {}
                 for child_field_values in field_values:
                     remapper_local, child_field_values = Remapper.prepare(
-                        self, remapper, related_model_class, field_name, child_field_values)
-                    child_lookup_fields = Mapper.flatten_lookup_fields(
-                        remapper_local.filter_lookup_fields(child_field_values))
+                        self, remapper, related_model_class, field_name, child_field_values, implicit_remappers)
+                    child_lookup_fields = remapper_local.filter_lookup_fields(child_field_values)
+                    children.append((remapper_local, child_lookup_fields, child_field_values))
+
+                prefetched_objects = Mapper.prefetch_objects(
+                    related_model_class, [child_lookup_fields for _, child_lookup_fields, _ in children],
+                    remapper is None or remapper.ownership == Ownership.NONE)
+                bulk_create = Mapper.can_bulk_create(related_model_class) and Mapper.can_defer_children(
+                    related_model_class, children)
+                unsaved_objects = []
+
+                for (remapper_local, child_lookup_fields, child_field_values), prefetched_object in zip(
+                        children, prefetched_objects):
                     child_result, child_changed, child_new_value = self._start_mapping(
-                        related_model_class, child_lookup_fields, child_field_values, remapper_local.ownership, )
+                        related_model_class, child_lookup_fields, child_field_values, remapper_local.ownership,
+                        prefetched_object, prefetched_object is not None, bulk_create)
 
                     if not child_result:
-                        self.logger.warning(f"Skip, related field `{field_name}` not ready for `{lookup_fields}`")
+                        self.logger.warning("Skip, related field `%s` not ready for `%s`", field_name, lookup_fields)
                         return False, False, None
 
                     list_of_fields.append(child_new_value)
 
-                    if not even or child_changed or child_new_value not in set_m2m:
+                    if child_new_value._state.adding:
+                        unsaved_objects.append(child_new_value)
+
+                    if not even or child_changed or child_new_value.pk not in set_m2m_pks:
                         should_update = True
 
+                if len(unsaved_objects) > 0:
+                    self.logger.debug("Creating %d objects of `%s` for `%s`", len(unsaved_objects), field_name,
+                                      lookup_fields)
+                    related_model_class.objects.bulk_create(unsaved_objects)
+
                 if len(list_of_fields) > 0 and should_update:
                     if remapper is not None and remapper.ownership == Ownership.SINGLE and set_m2m is not None:
+                        new_pks = {new_value.pk for new_value in list_of_fields}
                         for existing_value in set_m2m:
                             existing_value.refresh_from_db()
-                            if existing_value not in list_of_fields:
-                                self.logger.debug(f"""Deleting a removed related field from `{field_name}` """
-                                                  f"""for `{lookup_fields}`""")
+                            if existing_value.pk not in new_pks:
+                                self.logger.debug("Deleting a removed related field from `%s` for `%s`",
+                                                  field_name, lookup_fields)
                                 existing_value.delete()
+                                # Deletions can cascade to any model, so prefetched objects can't be trusted anymore.
+                                self.mom.prefetched_objects.clear()
+                                self.mom.prefetched_references.clear()
 
                     field_diff[field_name] = list_of_fields
             elif isinstance(django_field, ForeignKey):
-                if field_values is None and (not updating or getattr(db_object, field_name) is not None):
-                    field_diff[field_name] = None
+                if field_values is None:
+                    if not updating or current_value is not None:
+                        field_diff[field_name] = None
                     continue
 
                 related_model_class = django_field.related_model
+                if current_value is not None and (related_model_class, current_value.pk) in self.mom.changed_objects:
+                    # Selected along with a prefetched object, so it may have changed since.
+                    current_value.refresh_from_db()
+
                 remapper = Remapper.create_from(self.mom, related_model_class)
                 remapper, field_values = Remapper.prepare(self, remapper, related_model_class, field_name, field_values)
-                child_lookup_fields = Mapper.flatten_lookup_fields(remapper.filter_lookup_fields(field_values))
+                child_lookup_fields = remapper.filter_lookup_fields(field_values)
                 child_result, child_changed, child_new_value = self._start_mapping(
-                    related_model_class, child_lookup_fields, field_values, remapper.ownership,
-                    getattr(db_object, field_name) if updating else None)
+                    related_model_class, child_lookup_fields, field_values, remapper.ownership, current_value)
 
                 if not child_result:
-                    self.logger.warning(f"Skip, related field `{field_name}` not ready for `{lookup_fields}`")
+                    self.logger.warning("Skip, related field `%s` not ready for `%s`", field_name, lookup_fields)
                     return False, False, None
-                elif not updating or child_changed or child_new_value != getattr(db_object, field_name):
+                elif not updating or child_changed or child_new_value != current_value:
                     field_diff[field_name] = child_new_value
             else:
-                if updating and isinstance(field_values, DjangoFile):
+                if updating and type(field_values) is DjangoFile:
                     same = False
-                    file_field = getattr(db_object, field_name)
+                    file_field = current_value
 
                     if file_field is None:
-                        self.logger.debug(f"""The file for the field `{field_name}` wasn't defined yet: """
-                                          f"""`{lookup_fields}`""")
+                        self.logger.debug("The file for the field `%s` wasn't defined yet: `%s`",
+                                          field_name, lookup_fields)
                     else:
                         try:
-                            modified = getmtime(file_field.path)
-                            if field_values.file_size == file_field.size and field_values.date_modified == modified:
+                            stat = os.stat(file_field.path)
+                            if field_values.file_size == stat.st_size and field_values.date_modified == stat.st_mtime:
                                 same = True
                             else:
-                                self.logger.debug(f"""The file for the field `{field_name}` is different and will """
-                                                  f"""be updated for `{file_field.path}`""")
+                                self.logger.debug("The file for the field `%s` is different and will be updated "
+                                                  "for `%s`", field_name, file_field.path)
                         except FileNotFoundError:
-                            self.logger.debug(f"""The file for the field `{field_name}` doesn't exist: """
-                                              f"""`{file_field.path}`""")
+                            self.logger.debug("The file for the field `%s` doesn't exist: `%s`",
+                                              field_name, file_field.path)
 
                     if not same:
-                        self.logger.debug(f"The file for the field `{field_name}` will be updated.")
+                        self.logger.debug("The file for the field `%s` will be updated.", field_name)
                         field_diff[field_name] = field_values
-                elif not updating or field_values != getattr(db_object, field_name):
+                elif not updating or field_values != current_value:
                     field_diff[field_name] = field_values
 
         if len(field_diff) > 0:
-            self.logger.debug(f"Saving object `{lookup_fields}`")
+            self.logger.debug("Saving object `%s`", lookup_fields)
 
             primary_fields = {}
             secondary_fields = {}
 
             for key, value in field_diff.items():
-                if isinstance(value, list) or isinstance(value, DjangoFile):
+                if type(value) in SECONDARY_FIELD_TYPES:
                     secondary_fields[key] = value
                 else:
                     primary_fields[key] = value
@@ -383,59 +666,232 @@ class Mapper:
             if updating and ownership != Ownership.SHARED:
                 for key, value in primary_fields.items():
                     setattr(db_object, key, value)
+
+                update_fields = list(primary_fields.keys())
+                created = False
+                self.mom.changed_objects.add((model_class, db_object.pk))
+            elif defer_create and len(secondary_fields) == 0:
+                self.logger.debug("Deferring the creation of object `%s` to the caller", lookup_fields)
+                return True, True, model_class(**primary_fields)
             else:
                 db_object = model_class.objects.create(**primary_fields)
+                update_fields = []
+                created = True
 
             for key, value in secondary_fields.items():
-                if isinstance(value, DjangoFile):
+                if type(value) is DjangoFile:
                     file_field = getattr(db_object, key)
-                    file_field.save(value.file_name, value.file)
+                    with value.open() as file:
+                        file_field.save(value.file_name, file, save=False)
                     os.utime(file_field.path, (value.date_modified, value.date_modified))
-                elif isinstance(value, list):
-                    getattr(db_object, key).set(value)
-
-            db_object.save()
-            self.logger.debug(f"""Object has been {"updated" if updating else "created"} `{lookup_fields}` with """
-                              f"""`{list(field_diff.keys())}`""")
+                    update_fields.append(key)
+                elif type(value) is list:
+                    related_manager = getattr(db_object, key)
+                    if created:
+                        # A new object has no existing relations for `set()` to compare against.
+                        related_manager.add(*value)
+                    elif key in current_m2m_pks:
+                        # The current relations were already read for the comparison, so only the difference is
+                        # written instead of letting `set()` read them again.
+                        new_pks = {new_value.pk for new_value in value}
+                        removed_pks = current_m2m_pks[key] - new_pks
+                        if len(removed_pks) > 0:
+                            related_manager.remove(*removed_pks)
+                        added_values = [new_value for new_value in value if new_value.pk not in current_m2m_pks[key]]
+                        if len(added_values) > 0:
+                            related_manager.add(*added_values)
+                    else:
+                        related_manager.set(value)
+
+            if len(update_fields) > 0:
+                # Fields updated on every save would otherwise be left out by `update_fields`.
+                update_fields.extend(
+                    field_name for field_name in Mapper.get_auto_now_fields(model_class)
+                    if field_name not in update_fields
+                )
+                db_object.save(update_fields=update_fields)
+
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Object has been %s `%s` with `%s`", "updated" if updating else "created",
+                                  lookup_fields, list(field_diff.keys()))
         else:
-            self.logger.debug(f"Object is up-to-date `{lookup_fields}`")
+            self.logger.debug("Object is up-to-date `%s`", lookup_fields)
 
         return True, len(field_diff) > 0, db_object
 
     def start_mapping(self) -> bool:
         if not self.loaded:
+            db_object = self.mom.prefetched_objects.pop(self, None)
+            if db_object is not None and (self.model_class, db_object.pk) in self.mom.changed_objects:
+                db_object = None
+
             self.loaded, _, _ = self._start_mapping(
                 self.model_class,
                 {self.lookup_field_name: self.lookup_field_value},
                 self.fields,
                 Ownership.SINGLE,
+                db_object,
+                db_object is not None,
             )
         return self.loaded
 
+    @staticmethod
+    def prefetch_mappers(mom: MOM, mappers: list):
+        # Looks up the existing objects of all mappers with one query per map instead of one per mapper. Objects
+        # changed by another mapper before their own mapper starts are looked up again.
+        mappers_by_map = {}
+        references_by_model = {}
+        for mapper in mappers:
+            mappers_by_map.setdefault(mapper.map_name, []).append(mapper)
+
+        for map_mappers in mappers_by_map.values():
+            model_class = map_mappers[0].model_class
+            related_names = set()
+            prefetch_names = set()
+            # Related objects the mapping compares against are read along with the objects themselves.
+            for mapper in map_mappers:
+                for field_key, field_values in mapper.fields.items():
+                    field_name = field_key if ' ' not in field_key else Mapper.split_field_key(field_key)[0]
+                    try:
+                        django_field = Mapper.get_django_field(model_class, field_name)
+                    except FieldDoesNotExist:
+                        continue
+
+                    if isinstance(django_field, ManyToManyField):
+                        prefetch_names.add(field_name)
+                    elif isinstance(django_field, ForeignKey) and field_values is not None:
+                        related_names.add(field_name)
+                        if ' ' not in field_key:
+                            mapper._plan_reference(django_field, field_values, references_by_model)
+
+            prefetched_objects = Mapper.prefetch_objects(
+                model_class,
+                [{mapper.lookup_field_name: mapper.lookup_field_value} for mapper in map_mappers],
+                related_names=related_names,
+                prefetch_names=prefetch_names,
+            )
+            for mapper, prefetched_object in zip(map_mappers, prefetched_objects):
+                if prefetched_object is not None:
+                    mom.prefetched_objects[mapper] = prefetched_object
+
+        # Objects that mappers only refer to are looked up with one query per related model as well. Ones missing
+        # now may be created by a mapper that runs earlier, so they are looked up again when they are needed.
+        for related_model_class, lookup_fields_list in references_by_model.items():
+            prefetched_objects = Mapper.prefetch_objects(related_model_class, lookup_fields_list, True)
+            for lookup_fields, prefetched_object in zip(lookup_fields_list, prefetched_objects):
+                if prefetched_object is not None:
+                    mom.prefetched_references[(related_model_class, tuple(lookup_fields.items()))] = prefetched_object
+
+    def _plan_reference(self, django_field, field_values, references_by_model: dict):
+        related_model_class = django_field.related_model
+        remapper = Remapper.create_from(self.mom, related_model_class)
+        if remapper is not None and remapper.ownership != Ownership.NONE:
+            return
+
+        remapper, child_fields = Remapper.prepare(self, remapper, related_model_class, django_field.name, field_values)
+        references_by_model.setdefault(related_model_class, []).append(remapper.filter_lookup_fields(child_fields))
+
+    def _find_dependencies(self, model_class, fields: dict, mappers_by_key: dict, dependencies: set):
+        for field_key, field_values in fields.items():
+            field_name = field_key if ' ' not in field_key else Mapper.split_field_key(field_key)[0]
+            try:
+                django_field = Mapper.get_django_field(model_class, field_name)
+            except FieldDoesNotExist:
+                continue
+
+            if field_values is None or not django_field.is_relation or django_field.related_model is None:
+                continue
+
+            related_model_class = django_field.related_model
+            for child_field_values in field_values if type(field_values) is list else [field_values]:
+                if type(child_field_values) is dict:
+                    for lookup_name, lookup_value in child_field_values.items():
+                        dependency = mappers_by_key.get((related_model_class, lookup_name, str(lookup_value)))
+                        if dependency is not None:
+                            dependencies.add(dependency)
+
+                    self._find_dependencies(related_model_class, child_field_values, mappers_by_key, dependencies)
+                else:
+                    remapper = Remapper.create_from(self.mom, related_model_class)
+                    if remapper is not None and len(remapper.lookup_fields) == 1:
+                        lookup_name = remapper.lookup_fields[0]
+                    else:
+                        lookup_name = self.mom.implicit_lookup_fields.get(
+                            Remapper.full_class_name(related_model_class))
+
+                    dependency = mappers_by_key.get((related_model_class, lookup_name, str(child_field_values)))
+                    if dependency is not None:
+                        dependencies.add(dependency)
+
+    @staticmethod
+    def sort_by_dependencies(mappers: list) -> list:
+        # Orders the mappers so that the objects a mapper refers to are mapped before it. The references are found
+        # in the field values, so this is a best effort: mappers it misses, or that are part of a cycle, keep their
+        # relative order and are left to the retries in `mom_run`.
+        mappers_by_key = {
+            (mapper.model_class, mapper.lookup_field_name, str(mapper.lookup_field_value)): mapper
+            for mapper in mappers
+        }
+        dependents = {mapper: [] for mapper in mappers}
+        dependency_counts = {}
+
+        for mapper in mappers:
+            dependencies = set()
+            mapper._find_dependencies(mapper.model_class, mapper.fields, mappers_by_key, dependencies)
+            dependencies.discard(mapper)
+            dependency_counts[mapper] = len(dependencies)
+            for dependency in dependencies:
+                dependents[dependency].append(mapper)
+
+        ready = deque(mapper for mapper in mappers if dependency_counts[mapper] == 0)
+        sorted_mappers = []
+
+        while ready:
+            mapper = ready.popleft()
+            sorted_mappers.append(mapper)
+            for dependent in dependents[mapper]:
+                dependency_counts[dependent] -= 1
+                if dependency_counts[dependent] == 0:
+                    ready.append(dependent)
+
+        sorted_mappers.extend(mapper for mapper in mappers if dependency_counts[mapper] > 0)
+        return sorted_mappers
+
+    @staticmethod
+    def split_field_key(field_key: str) -> (str, frozenset):
+        if field_key not in _FIELD_KEY_CACHE:
+            field_name, *options = field_key.split(' ')
+            _FIELD_KEY_CACHE[field_key] = (field_name, frozenset(options))
+        return _FIELD_KEY_CACHE[field_key]
+
     def streamline_fields(self, fields: dict) -> dict:
         streamlined_fields = {}
-        for field_name, field_value in fields.items():
-            options = field_name.split(' ')
-            if len(options) > 1:
-                field_name = options[0]
-                options = options[1::]
+        for field_key, field_value in fields.items():
+            if ' ' not in field_key:
+                streamlined_fields[field_key] = field_value
+                continue
+
+            field_name, options = Mapper.split_field_key(field_key)
+            if options:
                 if 'file' in options:
                     file_path = join(self.pwd, field_value)
                     try:
-                        field_value = Path(file_path).read_text()
+                        if file_path not in self.file_contents:
+                            self.file_contents[file_path] = Path(file_path).read_text()
+                        field_value = self.file_contents[file_path]
                     except Exception as exc:
                         self.logger.error(f"Couldn't read the file '{file_path}' for {field_name}")
                         self.logger.exception(exc)
-                        exit(1)
+                        raise FileLoadException([file_path]) from exc
                 elif 'djangofile' in options:
                     file_path = join(self.pwd, field_value)
                     try:
-                        field_value = DjangoFile(field_value, getsize(file_path), open(file_path, 'rb'),
-                                                 getmtime(file_path))
+                        stat = os.stat(file_path)
+                        field_value = DjangoFile(field_value, stat.st_size, file_path, stat.st_mtime)
                     except Exception as exc:
                         self.logger.error(f"Couldn't read the file '{file_path}' for {field_name}")
                         self.logger.exception(exc)
-                        exit(1)
+                        raise FileLoadException([file_path]) from exc
 
             streamlined_fields[field_name] = field_value
 
@@ -466,12 +922,20 @@ class Remapper:
 
     @staticmethod
     def create_from(mom: MOM, related_model_class: object):
+        if related_model_class in mom.remappers:
+            return mom.remappers[related_model_class]
+
+        remapper = Remapper._create_from(mom, related_model_class)
+        mom.remappers[related_model_class] = remapper
+        return remapper
+
+    @staticmethod
+    def _create_from(mom: MOM, related_model_class: object):
         full_class_name = Remapper.full_class_name(related_model_class)
         self_remapping: dict
         lookup_fields: list
         ownership = Ownership.NONE
         lookup_fields_optional: list = []
-        logger = logging.getLogger(full_class_name)
 
         if full_class_name in mom.remapping:
             self_remapping = mom.remapping[full_class_name]
@@ -493,89 +957,110 @@ class Remapper:
                     logger.error(f"""{ownership_value} is not a possible value for `ownership`. Possible """
                                  f"""values are `{list(map(str, Ownership))}`""")
                     logger.exception(exc)
-                    exit(1)
+                    raise UnsupportedValueException(ownership_value) from exc
         else:
             return None
 
         return Remapper(lookup_fields, ownership, full_class_name, related_model_class, lookup_fields_optional)
 
     @staticmethod
-    def prepare(mapper: Mapper, self, related_model_class, field_name, child_fields) -> (object, dict):
-        if not isinstance(child_fields, dict):
+    def prepare(
+            mapper: Mapper,
+            self,
+            related_model_class,
+            field_name,
+            child_fields,
+            implicit_remappers: dict = None
+    ) -> (object, dict):
+        if type(child_fields) is not dict:
             if self is not None:
                 if len(self.lookup_fields) == 1:
                     child_fields = {self.lookup_fields[0]: child_fields}
                 else:
-                    logging.error(f"""Implicit passing of field `{field_name}` that holds `{self.full_class_name}` """
+                    logger.error(f"""Implicit passing of field `{field_name}` that holds `{self.full_class_name}` """
                                   f"""is not possible since it doesn't have exactly one lookup field: """
                                   f"""{self.lookup_fields}""")
-                    exit(1)
+                    raise ImplicitLookupException(field_name)
             else:
                 full_class_name = Remapper.full_class_name(related_model_class)
                 if full_class_name in mapper.mom.implicit_lookup_fields:
                     child_fields = {mapper.mom.implicit_lookup_fields[full_class_name]: child_fields}
                 else:
-                    logging.error(f"""Field `{field_name}` that holds `{full_class_name}` doesn't have a mapping to """
+                    logger.error(f"""Field `{field_name}` that holds `{full_class_name}` doesn't have a mapping to """
                                   f"""get the implicit lookup value from. Maybe you didn't intend to pass a value?""")
-                    exit(1)
+                    raise ImplicitLookupException(field_name)
 
         child_fields = mapper.streamline_fields(child_fields)
         if self is None:
-            self = Remapper(list(child_fields.keys()), Ownership.NONE, Remapper.full_class_name(related_model_class),
+            # Children of a list usually share their fields, so they can share the remapper built from them.
+            lookup_fields = tuple(child_fields.keys())
+            if implicit_remappers is not None and lookup_fields in implicit_remappers:
+                return implicit_remappers[lookup_fields], child_fields
+
+            self = Remapper(list(lookup_fields), Ownership.NONE, Remapper.full_class_name(related_model_class),
                             related_model_class)
+            if implicit_remappers is not None:
+                implicit_remappers[lookup_fields] = self
         return self, child_fields
 
     def filter_lookup_fields(self, fields: dict):
         lookup_fields: dict = {}
         for lookup_field in self.lookup_fields:
             if lookup_field in fields:
-                lookup_fields[lookup_field] = fields[lookup_field]
+                Remapper._add_lookup_field(lookup_fields, lookup_field, fields[lookup_field])
             else:
-                logging.error(f"Lookup field `{lookup_field}` of `{self.full_class_name}` wasn't given for `{fields}`")
-                exit(1)
+                logger.error(f"Lookup field `{lookup_field}` of `{self.full_class_name}` wasn't given for `{fields}`")
+                raise MissingLookupFieldException(lookup_field)
 
         if self.lookup_fields_optional is not None:
             for lookup_field in self.lookup_fields_optional:
-                if lookup_field in fields and lookup_field not in lookup_fields:
-                    lookup_fields[lookup_field] = fields[lookup_field]
+                if lookup_field in fields and lookup_field not in self.lookup_fields:
+                    Remapper._add_lookup_field(lookup_fields, lookup_field, fields[lookup_field])
         return lookup_fields
 
+    @staticmethod
+    def _add_lookup_field(lookup_fields: dict, lookup_field: str, value):
+        value_type = type(value)
+        if value_type is dict:
+            lookup_fields.update(Mapper.flatten_lookup_fields(value, lookup_field))
+        elif value_type is list:
+            logger.error("A list value cannot be flattened")
+            raise UnsupportedValueException
+        else:
+            lookup_fields[lookup_field] = value
+
     @staticmethod
     def full_class_name(related_model_class: object):
-        return "%s.%s" % (related_model_class.__module__, related_model_class.__qualname__)
+        if related_model_class not in _CLASS_NAME_CACHE:
+            _CLASS_NAME_CACHE[related_model_class] = "%s.%s" % (
+                related_model_class.__module__, related_model_class.__qualname__)
+        return _CLASS_NAME_CACHE[related_model_class]
 
 
-@transaction.non_atomic_requests
 def mom_run(mom_folder: str, mom_file: str):
-    logger = logging.getLogger(__name__)
     main_mom_file = join(mom_folder, mom_file)
     mom = MOM.load_from(main_mom_file)
-    mappers = Mapper.load_mappers_from(mom, mom_folder, mom_file)
+    mappers = Mapper.sort_by_dependencies(Mapper.load_mappers_from(mom, mom_folder, mom_file))
 
-    while True:
-        had_successful = False
-        had_missing = False
+    with transaction.atomic():
+        Mapper.prefetch_mappers(mom, mappers)
+        pending = mappers
 
-        for mapper in mappers:
-            if mapper.loaded:
-                continue
-            else:
-                had_missing = True
+        while len(pending) > 0:
+            retrying = []
 
-            if mapper.start_mapping():
-                had_successful = True
+            for mapper in pending:
+                if not mapper.start_mapping():
+                    retrying.append(mapper)
 
-        if had_missing:
-            if not had_successful:
-                for mapper in mappers:
-                    if not mapper.loaded:
-                        logger.error(f"""Failed => `{mapper.lookup_field_value}:{mapper.lookup_field_name}` """
-                                     f"""of `{mapper.map_name}`""")
+            if len(retrying) == len(pending):
+                for mapper in retrying:
+                    logger.error(f"""Failed => `{mapper.lookup_field_value}:{mapper.lookup_field_name}` """
+                                 f"""of `{mapper.map_name}`""")
 
-                logger.error("Failed to complete.")
-                exit(1)
-        else:
-            break
+                raise IncompleteMappingException([join(mapper.pwd, mapper.file) for mapper in retrying])
+
+            pending = retrying
 
     logger.info("Successful.")
 
@@ -588,4 +1073,21 @@ class Command(BaseCommand):
                             default=MOM_FILE)
 
     def handle(self, *args, **options):
-        mom_run(options['dir'], options['file'])
+        # Unless the project already handles these logs, they go to stderr while the command runs, at the level picked
+        # with `--verbosity`. The root logger is left alone.
+        handler = None
+        level = logger.level
+        if not logger.hasHandlers():
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            logger.addHandler(handler)
+            logger.setLevel(VERBOSITY_LOG_LEVELS.get(options['verbosity'], logging.DEBUG))
+
+        try:
+            mom_run(options['dir'], options['file'])
+        except MOMException as exc:
+            raise CommandError("Failed to complete.") from exc
+        finally:
+            if handler is not None:
+                logger.removeHandler(handler)
+                logger.setLevel(level)
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('slug', models.SlugField(primary_key=True, serialize=False)),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='test_app.category')),
+            ],
+        ),
+    ]
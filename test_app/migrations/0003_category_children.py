@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-15 22:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0002_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='children',
+            field=models.ManyToManyField(related_name='parents', to='test_app.category'),
+        ),
+    ]
@@ -54,3 +54,9 @@ class Post(models.Model):
 class File(models.Model):
     slug = models.SlugField(primary_key=True, )
     file = models.FileField(upload_to=upload_with_unique_name)
+
+
+class Category(models.Model):
+    slug = models.SlugField(primary_key=True, )
+    parent = models.ForeignKey('self', null=True, on_delete=models.PROTECT)
+    children = models.ManyToManyField('self', symmetrical=False, related_name='parents')
@@ -1,19 +1,43 @@
-from distutils.dir_util import copy_tree
+import logging
+from os.path import join
+from shutil import copytree
+from unittest import mock
 
 from django.conf import settings
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import TestCase
 from tempdir import TempDir
 
-from test_app.models import ContentData, Language, Post, Tag, File
+from django_mom.management.commands.mom import FileLoadException, IncompleteMappingException, Mapper
+from test_app.models import Author, Category, ContentData, Language, Post, Tag, File
 
 
 def apply_test_data(folder_name: str):
-    with TempDir() as mom_data:
-        copy_tree('test_data/%s' % folder_name, mom_data)
+    with TempDir() as temp_dir:
+        # `copytree` needs a destination that doesn't exist yet.
+        mom_data = join(temp_dir, folder_name)
+        copytree('test_data/%s' % folder_name, mom_data)
         call_command('mom', '-d', mom_data)
 
 
+def apply_test_data_reversed(folder_name: str) -> (int, int):
+    # Lists the mappers in reverse, so dependents come before their dependencies, and counts the mapping attempts.
+    load_mappers_from = Mapper.load_mappers_from
+    mapper_count = 0
+
+    def load_mappers_reversed(*args):
+        nonlocal mapper_count
+        mappers = load_mappers_from(*args)
+        mapper_count = len(mappers)
+        return sorted(mappers, key=lambda mapper: (mapper.map_name, mapper.lookup_field_value), reverse=True)
+
+    with mock.patch.object(Mapper, 'load_mappers_from', side_effect=load_mappers_reversed), \
+            mock.patch.object(Mapper, 'start_mapping', autospec=True, side_effect=Mapper.start_mapping) as start_mapping:
+        apply_test_data(folder_name)
+
+    return mapper_count, start_mapping.call_count
+
+
 class CreateObjects(TestCase):
     def test_populate_simple(self):
         apply_test_data('populate_simple')
@@ -56,11 +80,23 @@ class CreateObjects(TestCase):
 
         post_one.refresh_from_db()
         self.assertIsNone(post_one.change, 'Change should be `None` after update')
+        self.assertEquals(sorted(map(map_tag_slug, post_one.tag.all())), ['fantasy', 'sci-fi'])
 
         post_two.refresh_from_db()
         self.assertEquals(post_two.author.profile.first_name, 'Auther')
         self.assertEquals(post_two.author.profile.last_name, 'Written')
 
+    def test_populate_all_reapply(self):
+        apply_test_data('populate_all')
+        counts = [model.objects.count() for model in (Author, ContentData, Language, Post, Tag)]
+
+        apply_test_data('populate_all')
+
+        self.assertEquals([model.objects.count() for model in (Author, ContentData, Language, Post, Tag)], counts,
+                          'Reapplying the same data should not create any objects')
+        self.assertEquals(Language.objects.get(code='tr').name, 'Türkçe')
+        self.assertEquals(Post.objects.get(slug='my-second-post').author.username, 'auther')
+
     def test_feature_implicit_passing(self):
         apply_test_data('feature_implicit_passing')
 
@@ -70,6 +106,26 @@ class CreateObjects(TestCase):
         self.assertEquals(only_content.language.code, 'en')
         self.assertEquals(only_content.language.name, 'English')
 
+    def test_mixed_lookups(self):
+        apply_test_data('mixed_lookups')
+
+        # The second child has no `content`, so its `title` lookup finds the first child instead of creating another.
+        post = Post.objects.get(slug='my-post')
+        self.assertEquals(post.content_data.get().content, 'Content')
+
+        other_post = Post.objects.get(slug='other')
+        self.assertEquals(sorted(other_post.content_data.values_list('title', flat=True)), ['First', 'Second'])
+        self.assertEquals(ContentData.objects.count(), 3)
+
+    def test_self_reference(self):
+        apply_test_data('self_reference')
+        apply_test_data('self_reference')
+
+        # `b` refers to its sibling `a`, so the children can't wait to be inserted together.
+        self.assertEquals(Category.objects.count(), 3)
+        self.assertEquals(Category.objects.get(slug='b').parent_id, 'a')
+        self.assertEquals(sorted(Category.objects.get(slug='root').children.values_list('slug', flat=True)), ['a', 'b'])
+
     def test_nested_discovery(self):
         apply_test_data('nested')
 
@@ -105,6 +161,61 @@ class CreateObjects(TestCase):
         self.assertEquals(Post.objects.count(), 1, 'Single ownership fields should be deleted when removed')
         self.assertEquals(Tag.objects.count(), 4, 'Shared ownership fields should retain their existence when removed')
 
+    def test_dependency_order(self):
+        mapper_count, attempts = apply_test_data_reversed('populate_all')
+
+        self.assertEquals(attempts, mapper_count, 'Every mapper should run once, after the ones it depends on')
+        self.assertEquals(Post.objects.get(slug='my-second-post').author.username, 'auther')
+
+    def test_dependency_cycle(self):
+        apply_test_data('dependency_cycle_base')
+        mapper_count, attempts = apply_test_data_reversed('dependency_cycle')
+
+        # `b` runs first, but `a` doesn't exist yet, so it is retried after `a` is created.
+        self.assertEquals(attempts, mapper_count + 1)
+        self.assertEquals(Category.objects.get(slug='a').parent_id, 'b')
+        self.assertEquals(Category.objects.get(slug='b').parent_id, 'a')
+
+    def test_rollback(self):
+        with self.assertRaises(CommandError) as context:
+            apply_test_data('rollback')
+
+        cause = context.exception.__cause__
+        self.assertIsInstance(cause, IncompleteMappingException)
+        failed_files = sorted(cause.args[0])
+        self.assertEquals(len(failed_files), 2)
+        self.assertTrue(failed_files[0].endswith(join('rollback', 'post.orphan.mom.yaml')))
+        self.assertTrue(failed_files[1].endswith(join('rollback', 'post', 'stray', 'mom.yaml')),
+                        'Mappers in folders should be told apart by their paths')
+
+        self.assertEquals(Language.objects.count(), 0, 'Objects created before the failure should be rolled back')
+        self.assertEquals(Post.objects.count(), 0)
+
+    def test_invalid_files(self):
+        with self.assertRaises(CommandError) as context:
+            apply_test_data('invalid_files')
+
+        cause = context.exception.__cause__
+        self.assertIsInstance(cause, FileLoadException)
+        self.assertEquals(len(cause.args[0]), 2, 'Every invalid file should be reported at once')
+        self.assertEquals(Language.objects.count(), 0)
+
+    def test_invalid_index(self):
+        with self.assertRaises(CommandError) as context:
+            apply_test_data('invalid_index')
+
+        cause = context.exception.__cause__
+        self.assertIsInstance(cause, FileLoadException)
+        self.assertEquals(len(cause.args[0]), 1)
+        self.assertTrue(cause.args[0][0].endswith(join('invalid_index', 'mom.yaml')))
+
+    def test_logging_left_alone(self):
+        root_handlers = list(logging.getLogger().handlers)
+        apply_test_data('populate_simple')
+
+        self.assertEquals(logging.getLogger().handlers, root_handlers, 'The root logger should not be configured')
+        self.assertEquals(logging.getLogger('django_mom.management.commands.mom').handlers, [])
+
     def test_options(self):
         with TempDir() as media_root:
             settings.MEDIA_ROOT = media_root